@@ -106,6 +106,13 @@ class TopKPoolingNet(nn.Module):
 
     def forward(self, sample):
         x, edge_index = sample.x, sample.edge_index
+        # Precomputed sparse adjacency when available, it is valid until the graph is pooled
+        adj = sample.adj_t if "adj_t" in sample else edge_index
+        # A Batch carries the graph assignment of every node, a single Data does not
+        if sample.batch is not None:
+            batch, num_graphs = sample.batch, sample.num_graphs
+        else:
+            batch, num_graphs = torch.zeros(len(x), dtype=torch.long, device=x.device), 1
 
         # Dropout layer
         # edge_index = self.dropout_edges(edge_index, dropout=0.2)
@@ -113,9 +120,9 @@ class TopKPoolingNet(nn.Module):
         x = self.dense_input(x, self.empty_edges)
         x = F.gelu(x)
 
-        x = self.input(x, edge_index)
+        x = self.input(x, adj)
         x = F.gelu(x)
-        x = self.conv1(x, edge_index)
+        x = self.conv1(x, adj)
         x = F.gelu(x)
 
         # if self.pooling_layers > 1:
@@ -123,15 +130,17 @@ class TopKPoolingNet(nn.Module):
         #     pooled = self.topkpool1(x, edge_index, batch=batch)
         #     x, edge_index = pooled[0], pooled[1]
 
-        x = self.conv2(x, edge_index)
+        x = self.conv2(x, adj)
         x = F.gelu(x)
 
         if self.pooling_layers > 0:
-            batch = torch.tensor([0 for _ in x], dtype=torch.long, device=self.device)
             pooled = self.topkpool2(x, edge_index, batch=batch)
+            # EdgePooling returns (x, edge_index, batch, unpool_info), the others (x, edge_index, attr, batch, ...)
             x, edge_index = pooled[0], pooled[1]
+            batch = pooled[2] if isinstance(self.topkpool2, EdgePooling) else pooled[3]
+            adj = edge_index
 
-        x = self.conv3(x, edge_index)
+        x = self.conv3(x, adj)
         x = F.gelu(x)
 
         # For large graphs
@@ -142,24 +151,28 @@ class TopKPoolingNet(nn.Module):
         #     x = self.conv4(x, edge_index)
         #     x = F.gelu(x)
 
-        batch = torch.tensor([0 for _ in x], dtype=torch.long, device=self.device)
         # With sort_pool it works but we have the same problem: the output layer learns the order of the pooled nodes
         # using k = 3, let's see what happens by shuffling the nodes
         if self.final_pooling == "avg_pool_x":
-            cluster = torch.as_tensor([i % self.final_nodes for i in range(len(x))], device=self.device)
-            (x, cluster) = avg_pool_x(cluster, x, batch)
+            (x, cluster) = avg_pool_x(self.node_clusters(batch), x, batch)
         elif self.final_pooling == "sort_pooling":
             x = global_sort_pool(x, batch, self.final_nodes)
         elif self.final_pooling == "topk" or self.final_pooling == "asap" or self.final_pooling == "sag":
-            pooled = self.last_pooling_layer(x, edge_index)
+            pooled = self.last_pooling_layer(x, edge_index, batch=batch)
             x = pooled[0]
         elif self.final_pooling == "max_pool_x":
-            cluster = torch.as_tensor([i % self.final_nodes for i in range(len(x))], device=self.device)
-            (x, cluster) = max_pool_x(cluster, x, batch)
+            (x, cluster) = max_pool_x(self.node_clusters(batch), x, batch)
             # (x2, cluster2) = avg_pool_x(cluster, x, batch)
             # x = torch.cat([x1.view(-1), x2.view(-1)])
 
-        return self.output(x.view(-1))
+        return self.output(x.view(num_graphs, -1))
+
+    def node_clusters(self, batch):
+        # Node position inside its own graph modulo final_nodes, offset so that clusters never span two graphs
+        counts = torch.bincount(batch)
+        starts = torch.cumsum(counts, dim=0) - counts
+        position = torch.arange(len(batch), device=batch.device) - starts[batch]
+        return batch * self.final_nodes + position % self.final_nodes
 
     def dropout_edges(self, edge_index, dropout):
         # Do not drop anything in validation/test
@@ -60,7 +60,8 @@ class LinearNet(nn.Module):
         self.layers = layers
 
     def forward(self, sample):
-        x = sample.x.view(-1)
+        # One row per graph: a Batch holds num_graphs graphs of self.nodes nodes each
+        x = sample.x.view(-1, self.nodes * self.nodes_features)
 
         x = self.input(x)
         x = F.gelu(x)
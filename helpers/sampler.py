@@ -0,0 +1,31 @@
+import torch
+
+
+class BucketBatchSampler():
+    """Batch together graphs with a similar number of nodes, so that the
+    shapes seen by the model are stable from a batch to the next one.
+    This object can be used as batch_sampler in PyTorch data loaders.
+
+    Args:
+        sizes (list): The number of nodes of every graph in the dataset.
+        batch_size (int): Graphs per batch.
+        shuffle (bool): Shuffle graphs of the same size and the order of the batches at every epoch.
+    """
+
+    def __init__(self, sizes, batch_size, shuffle=True):
+        self.sizes = torch.as_tensor(sizes, dtype=torch.long)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        # Tensor ops only, no pure Python shuffle or sort of the whole training set
+        indexes = torch.randperm(len(self.sizes)) if self.shuffle else torch.arange(len(self.sizes))
+        # Stable sort: graphs with the same size keep the random order
+        indexes = indexes[torch.argsort(self.sizes[indexes], stable=True)]
+        batches = indexes.split(self.batch_size)
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches))]
+        return iter([batch.tolist() for batch in batches])
+
+    def __len__(self):
+        return (len(self.sizes) + self.batch_size - 1) // self.batch_size
@@ -37,11 +37,10 @@ class StandardScaler():
 
 def compute_std_mean(samples, edges=True):
     def std_mean(index):
-        population = torch.zeros(size=(len(samples[0][index]) * len(samples), len(samples[0][index][0])))
-        for i, sample in enumerate(samples):
-            population[i*len(sample[index]):i*len(sample[index])+len(sample[index]), :] = sample[index]
+        # One (sum of rows, features) matrix, reduced in a single call
+        population = torch.cat([sample[index] for sample in samples], dim=0)
 
-        return torch.mean(population, dim=0), torch.std(population, dim=0)
+        return torch.mean(population, dim=0), torch.std(population, dim=0).clamp_min(1e-8)
 
     mean_nodes, std_nodes = std_mean(index=0)
     if edges:
@@ -51,24 +50,34 @@ def compute_std_mean(samples, edges=True):
         return mean_nodes, std_nodes
 
 
+def standardize(samples, index, mean, std):
+    # Normalize every sample at once and split back into per-sample views
+    population = torch.cat([sample[index] for sample in samples], dim=0)
+    sizes = [len(sample[index]) for sample in samples]
+    return ((population - mean) / std).split(sizes, dim=0)
+
+
 def normalize(samples, train_ind, edges=True):
     # Normalize mean = 0 and variance = 1
     training_samples = [samples[i] for i in train_ind]
     if edges:
         mean_nodes, std_nodes, mean_edges, std_edges = compute_std_mean(training_samples)
+        nodes = standardize(samples, 0, mean_nodes, std_nodes)
+        edge_features = standardize(samples, 2, mean_edges, std_edges)
 
         return [
             (
-                (sample[0] - mean_nodes) / std_nodes,
+                nodes[i],
                 sample[1],
-                (sample[2] - mean_edges) / std_edges
+                edge_features[i]
             ) for i, sample in enumerate(samples)
         ]
     else:
         mean_nodes, std_nodes = compute_std_mean(training_samples, edges=False)
+        nodes = standardize(samples, 0, mean_nodes, std_nodes)
         return [
             (
-                (sample[0] - mean_nodes) / std_nodes,
+                nodes[i],
                 sample[1]
             ) for i, sample in enumerate(samples)
         ]
@@ -0,0 +1,33 @@
+import torch
+
+
+def save_shard(samples, path, metadata):
+    # All the graphs in one file: node features and edges are concatenated,
+    # node_ptr/edge_ptr hold the offsets of every graph.
+    # A graph without edges has a 1-D edge_index, view(2, -1) makes it (2, 0)
+    edge_indexes = [sample[1].view(2, -1) for sample in samples]
+    node_counts = torch.tensor([len(sample[0]) for sample in samples])
+    edge_counts = torch.tensor([edge_index.size(1) for edge_index in edge_indexes])
+    torch.save({
+        "metadata": metadata,
+        "x": torch.cat([sample[0] for sample in samples], dim=0),
+        "edge_index": torch.cat(edge_indexes, dim=1),
+        "node_ptr": torch.cat([torch.zeros(1, dtype=torch.long), torch.cumsum(node_counts, dim=0)]),
+        "edge_ptr": torch.cat([torch.zeros(1, dtype=torch.long), torch.cumsum(edge_counts, dim=0)]),
+    }, path)
+
+
+def load_shard(path, metadata):
+    # Memory-mapped: each graph is a zero-copy slice of the concatenated tensors.
+    # edge_index is stored per graph (not offset), so slices can be used directly.
+    # Returns None when the shard was built with different settings
+    shard = torch.load(path, mmap=True, weights_only=True)
+    if shard.get("metadata") != metadata:
+        return None
+    node_ptr, edge_ptr = shard["node_ptr"].tolist(), shard["edge_ptr"].tolist()
+    return [
+        (
+            shard["x"][node_ptr[i]:node_ptr[i + 1]],
+            shard["edge_index"][:, edge_ptr[i]:edge_ptr[i + 1]]
+        ) for i in range(len(node_ptr) - 1)
+    ]
@@ -7,6 +7,9 @@ import json
 from datetime import datetime
 import time
 import os
+import gc
+import sys
+import multiprocessing
 from pprint import pprint
 import tqdm
 from coolmom_pytorch import SGD
@@ -15,6 +18,8 @@ import torch
 from torch.nn import L1Loss
 import torch.optim as optim
 from torch_geometric.data import Data
+from torch_geometric.loader import DataLoader
+from torch_geometric.transforms import ToSparseTensor
 from torch_geometric.nn import TopKPooling, SAGPooling
 import optuna
 
@@ -22,10 +27,13 @@ import optuna
 from helpers import mol2graph
 from helpers.EarlyStopping import EarlyStopping
 from helpers.scale import normalize
+from helpers.shard import save_shard, load_shard
+from helpers.sampler import BucketBatchSampler
 from GraphPoolingNets import TopKPoolingNet, GraphConvPoolNet
 from LinearNet import LinearNet
 from torch_geometric.nn.conv import GraphConv, GATConv
 
+# Requires PyTorch >= 2.3 (torch.compile, torch.load(mmap=True), torch.amp.GradScaler(device))
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 if device == "cpu":
     warn("You are using CPU instead of CUDA. The computation will be longer...")
@@ -35,11 +43,24 @@ if device == "cpu":
 DATASET_TYPE = "medium"
 DATA_DIR = f"ala_dipep_{DATASET_TYPE}"
 TARGET_FILE = f"free-energy-{DATASET_TYPE}.dat"
+SHARD_FILE = f"{DATA_DIR}/dihedrals-graph.pt"  # all the graphs of DATA_DIR in a single file
 N_SAMPLES = 3815 if DATASET_TYPE == "small" else 21881 if DATASET_TYPE == "medium" else 50000 if DATASET_TYPE == "old" else 64074 if DATASET_TYPE == "big" else 48952
 NORMALIZE_DATA = True
 NORMALIZE_TARGET = True
 OVERWRITE_PICKLES = False
 UNSEEN_REGION = None  # can be "left", "right" or None. When is "left" we train on "right" and predict on "left"
+SPARSE_ADJACENCY = False  # store adj_t (needs torch_sparse) for the graph convolutions, LinearNet ignores edges
+BATCH_SIZE = 64  # graphs per mini-batch, merged by PyG into a single disconnected graph
+# lr = 0.001 was tuned with one graph per step. Square root scaling keeps the update noise comparable
+# with ~BATCH_SIZE times fewer steps; BATCH_SIZE = 1 gives back the original setting
+LEARNING_RATE = 0.001 * BATCH_SIZE ** 0.5
+NUM_WORKERS = 4  # DataLoader processes collating the next training batches while the GPU works
+COMPILE_MODEL = True  # TorchInductor kernel fusion
+COMPILE_MODE = "reduce-overhead"  # also replay the compiled model as CUDA graphs, "default" for fusion only
+USE_AMP = device.type == "cuda"  # mixed precision training
+# bfloat16 needs native support (Ampere, compute capability >= 8.0), older GPUs train in float16
+# and the loss is scaled by a GradScaler
+AMP_DTYPE = torch.bfloat16 if USE_AMP and torch.cuda.get_device_capability(device)[0] >= 8 else torch.float16
 
 if not OVERWRITE_PICKLES:
     warn("You are using EXISTING pickles, change this setting if you add features to nodes/edges ")
@@ -63,6 +84,31 @@ run_parameters = {
 }
 
 
+def _load_one(i):
+    # Module level so that multiprocessing workers can pickle it
+    try:
+        if OVERWRITE_PICKLES:
+            raise FileNotFoundError
+
+        with open("{}/{}-dihedrals-graph.pickle".format(DATA_DIR, i), "rb") as p:
+            debruijn = pickle.load(p)
+
+    except FileNotFoundError:
+        atoms, edges, angles, dihedrals = mol2graph.get_richgraph("{}/{}.json".format(DATA_DIR, i))
+
+        debruijn = mol2graph.get_central_overlap_graph(atoms, angles, dihedrals, shuffle=run_parameters["shuffle"],
+                                                       sin_cos_decomposition=run_parameters["sin_cos"])
+
+        # Every sample has its own pickle, so workers never write to the same file
+        if OVERWRITE_PICKLES:
+            with open("{}/{}-dihedrals-graph.pickle".format(DATA_DIR, i), "wb") as p:
+                pickle.dump(debruijn, p)
+
+    # numpy arrays go back to the parent as plain pickled bytes, tensors would each get
+    # their own shared memory segment and file descriptor
+    return debruijn[0].numpy(), debruijn[1].numpy(), debruijn[2]
+
+
 def read_dataset(train_perc):
     run_parameters["train_split"] = train_perc
     if UNSEEN_REGION is not None:
@@ -81,47 +127,48 @@ def read_dataset(train_perc):
         else:
             indexes = right
 
-        train_ind = [i for i in range(N_SAMPLES) if i not in indexes]
+        # set for O(1) membership, indexes stays a list to be shuffled
+        indexes_set = set(indexes)
+        train_ind = [i for i in range(N_SAMPLES) if i not in indexes_set]
         # half to validation, half to test
         random.shuffle(indexes)
-        split = np.int(0.5 * len(indexes))
+        split = int(0.5 * len(indexes))
         validation_ind = indexes[:split]
         test_ind = indexes[split:]
     else:
         indexes = [i for i in range(N_SAMPLES)]
         random.shuffle(indexes)
-        indexes = indexes[:np.int(run_parameters["dataset_perc"] * N_SAMPLES)]
-        split = np.int(run_parameters["train_split"] * len(indexes))
+        indexes = indexes[:int(run_parameters["dataset_perc"] * N_SAMPLES)]
+        split = int(run_parameters["train_split"] * len(indexes))
         train_ind = indexes[:split]
-        split_2 = split + np.int(run_parameters["validation_split"] * len(indexes))
+        split_2 = split + int(run_parameters["validation_split"] * len(indexes))
         validation_ind = indexes[split:split_2]
         test_ind = indexes[split_2:]
 
-    graph_samples = []
-    for i in range(N_SAMPLES):
-        try:
-            if OVERWRITE_PICKLES:
-                raise FileNotFoundError
-
-            with open("{}/{}-dihedrals-graph.pickle".format(DATA_DIR, i), "rb") as p:
-                debruijn = pickle.load(p)
-
-        except FileNotFoundError:
-            atoms, edges, angles, dihedrals = mol2graph.get_richgraph("{}/{}.json".format(DATA_DIR, i))
-
-            debruijn = mol2graph.get_central_overlap_graph(atoms, angles, dihedrals, shuffle=run_parameters["shuffle"],
-                                                           sin_cos_decomposition=run_parameters["sin_cos"])
-
-            if OVERWRITE_PICKLES:
-                with open("{}/{}-dihedrals-graph.pickle".format(DATA_DIR, i), "wb") as p:
-                    pickle.dump(debruijn, p)
-
-        graph_samples.append(debruijn)
-
-    with open(TARGET_FILE, "r") as t:
-        target = torch.as_tensor([torch.tensor([float(v)]) for v in t.readlines()][:N_SAMPLES])
-        if not NORMALIZE_TARGET:
-            target = target.reshape(shape=(len(target), 1))
+    # A shard is only reused if it was built with the same samples and graph settings
+    shard_metadata = {
+        "n_samples": N_SAMPLES,
+        "sin_cos": run_parameters["sin_cos"],
+        "shuffle": run_parameters["shuffle"],
+    }
+    graph_samples = None
+    if not OVERWRITE_PICKLES and os.path.exists(SHARD_FILE):
+        graph_samples = load_shard(SHARD_FILE, shard_metadata)
+        if graph_samples is None:
+            warn(f"{SHARD_FILE} was built with different settings, rebuilding it")
+
+    if graph_samples is None:
+        # Loading/building the graphs is independent for every sample: spread it over all the cores
+        with multiprocessing.Pool() as pool:
+            graph_samples = [
+                (torch.from_numpy(x), torch.from_numpy(edge_index), nodes)
+                for x, edge_index, nodes in pool.map(_load_one, range(N_SAMPLES), chunksize=64)
+            ]
+        # Built once, the next runs read the shard instead of one pickle per sample
+        save_shard(graph_samples, SHARD_FILE, shard_metadata)
+
+    # One C-level parse into a (N_SAMPLES, 1) float32 tensor
+    target = torch.from_numpy(np.loadtxt(TARGET_FILE, dtype=np.float32, max_rows=N_SAMPLES)).view(-1, 1)
 
     # Compute STD and MEAN only on training data
     target_mean, target_std = 0, 1
@@ -130,6 +177,8 @@ def read_dataset(train_perc):
         target_std = torch.std(target, dim=0)
         target_mean = torch.mean(target, dim=0)
         target = ((target - target_mean) / target_std).reshape(shape=(len(target), 1))
+        # Plain floats from here on: only used to rescale the losses
+        target_mean, target_std = target_mean.item(), target_std.item()
 
     if NORMALIZE_DATA:
         # Single graph normalization
@@ -137,13 +186,25 @@ def read_dataset(train_perc):
     else:
         samples = graph_samples
 
+    # Kept on CPU: the DataLoader collates mini-batches which are then moved to the device.
+    # Every y is a (1, 1) view of the contiguous target tensor, PyG concatenates them in batch.y
     dataset = []
     for i, sample in enumerate(samples):
         dataset.append(
-            Data(x=sample[0], edge_index=sample[1], y=target[i]).to(device)
+            Data(x=sample[0], edge_index=sample[1], y=target[i:i + 1])
         )
 
-    return dataset, train_ind, validation_ind, test_ind, target_mean, target_std
+    if SPARSE_ADJACENCY:
+        # Sorted once here instead of at every forward. edge_index is kept for the pooling layers
+        to_sparse = ToSparseTensor(remove_edge_index=False)
+        dataset = [to_sparse(data) for data in dataset]
+
+    # Release the sample lists and the raw node features before training. The Data objects still reference
+    # the normalized x (views of a single tensor) and edge_index (views of the memory-mapped shard)
+    del samples, graph_samples
+    gc.collect()
+
+    return dataset, target, train_ind, validation_ind, test_ind, target_mean, target_std
 
 
 def define_model(sample):
@@ -206,52 +267,90 @@ def objective():
     random.seed(seed)
     torch.manual_seed(seed)
     train_perc = 0.1
-    dataset, train_ind, validation_ind, test_ind, target_mean, target_std = read_dataset(train_perc)
+    dataset, target, train_ind, validation_ind, test_ind, target_mean, target_std = read_dataset(train_perc)
+    # Training batches are reshuffled every epoch: collate them in background workers, from pinned memory
+    # so the copy is asynchronous. A prefetch_factor larger than 2 does not help and costs memory
+    # Batches are made of graphs with a similar number of nodes: fewer torch.compile recompilations
+    train_sampler = BucketBatchSampler([dataset[j].num_nodes for j in train_ind], BATCH_SIZE)
+    train_loader = DataLoader([dataset[j] for j in train_ind], batch_sampler=train_sampler,
+                              pin_memory=device.type == "cuda", num_workers=NUM_WORKERS,
+                              persistent_workers=NUM_WORKERS > 0, prefetch_factor=2 if NUM_WORKERS > 0 else None)
+    # Validation and test sets never change: move them to the device once and reuse them for every model
+    validation_batches = [batch.to(device) for batch in DataLoader([dataset[j] for j in validation_ind],
+                                                                   batch_size=BATCH_SIZE)]
+    test_batches = [batch.to(device) for batch in DataLoader([dataset[j] for j in test_ind], batch_size=BATCH_SIZE)]
+    # All the targets in a single device tensor (the Data.y are views of target), gathered with one indexing operation
+    y_all = target.to(device)
+    y_test = y_all[test_ind]
     for model, hyperparameters in define_linear_model(dataset[0]):
         seed += 1
         model = model.to(device)
+        if COMPILE_MODEL:
+            # dynamic=True: batches have a variable number of nodes, avoid recompiling for each shape.
+            # The first steps are slower because they trigger the compilation.
+            # With "reduce-overhead" the forward and backward graphs of the model are recorded as CUDA graphs,
+            # one per input shape (bucketing by size keeps them few, the last partial batch adds one).
+            # A replay overwrites the outputs of the previous call: consume or clone them before calling again
+            model = torch.compile(model, dynamic=True, mode=COMPILE_MODE)
         stopping = EarlyStopping(run_parameters["patience"])
         pprint(hyperparameters)
         print(model)
         criterion = L1Loss()
-        lr = 0.001#0.0003
-        betta=(1-0.99)**(1/(run_parameters["epochs"]*2187))
+        lr = LEARNING_RATE#0.0003
+        run_parameters["learning_rate"] = lr
+        run_parameters["batch_size"] = BATCH_SIZE
+        # cooling spread over the total number of optimizer steps
+        betta=(1-0.99)**(1/(run_parameters["epochs"]*len(train_loader)))
         print("betta", betta) 
 #        optimizer = optim.SGD(model.parameters(), lr=lr, momentum=0.84, weight_decay=0.0001)
 
         optimizer = SGD(model.parameters(), lr=lr, momentum=0.99,  weight_decay=0.0001, beta=betta)
+        # bfloat16 has the range of float32, loss scaling is only needed for float16
+        scaler = torch.amp.GradScaler(device.type, enabled=USE_AMP and AMP_DTYPE == torch.float16)
+
+        def train_step(batch):
+            with torch.autocast(device_type=device.type, dtype=AMP_DTYPE, enabled=USE_AMP):
+                # Forward pass: Compute predicted y by passing x to the model
+                y_pred = model(batch)
 
+                # Compute and print loss
+                loss = criterion(y_pred, batch.y)
+            # Perform a backward pass
+            scaler.scale(loss).backward()
+            return loss.detach()
 
         for i in range(run_parameters["epochs"]):
             model.train()
-            random.shuffle(train_ind)
-            train_losses = []
-            for number, j in enumerate(tqdm.tqdm(train_ind)):
-                # Forward pass: Compute predicted y by passing x to the model
-                y_pred = model(dataset[j].to(device))
-                
-                # Compute and print loss
-                loss = criterion(y_pred, dataset[j].y)
+            # Accumulated on the device, .item() would synchronize at every step
+            train_loss_sum = torch.zeros((), device=device)
+            # Refresh at most once per second, no progress bar when the output is not a terminal
+            for number, batch in enumerate(tqdm.tqdm(train_loader, mininterval=1.0, disable=not sys.stderr.isatty())):
+                batch = batch.to(device, non_blocking=True)
                 # Zero gradients, perform a backward pass, and update the weights.
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
-                train_losses.append(loss.item())
-
-            train_loss = torch.mean(torch.as_tensor(train_losses)).item()
+                optimizer.zero_grad(set_to_none=True)
+                # A new iteration: the CUDA graph outputs of the previous step are no longer needed
+                torch.compiler.cudagraph_mark_step_begin()
+                loss = train_step(batch)
+                scaler.step(optimizer)
+                scaler.update()
+                # weight by batch size, the last batch can be smaller
+                train_loss_sum += loss * batch.num_graphs
+
+            train_loss = (train_loss_sum / len(train_ind)).item()
             if NORMALIZE_TARGET:
                 train_loss = train_loss * target_std
             # Compute validation loss
             model.eval()
-            val_losses = []
+            val_loss_sum = torch.zeros((), device=device)
             # save some memory
             with torch.no_grad():
-                for j in validation_ind:
-                    y_pred = model(dataset[j].to(device))
-                    val_loss = criterion(y_pred, dataset[j].y)
-                    val_losses.append(val_loss.item())
+                for batch in validation_batches:
+                    y_pred = model(batch)
+                    val_loss = criterion(y_pred, batch.y)
+                    val_loss_sum += val_loss * batch.num_graphs
 
-                val_loss = torch.mean(torch.as_tensor(val_losses)).item()
+                # Single synchronization for the whole validation set
+                val_loss = (val_loss_sum / len(validation_ind)).item()
                 if NORMALIZE_TARGET:
                     val_loss = val_loss * target_std
                 print("Epoch {} - Validation MAE: {:.2f} - Train MAE: {:.2f}".format(i + 1, val_loss, train_loss))
@@ -262,17 +361,19 @@ def objective():
                     print(f"Training finished because of early stopping. Best loss on validation: {stopping.best_score:.2f}")
                     break
 
-        predictions, errors = [], []
+        predictions = []
         model.eval()
-        for j in test_ind:
-            # Forward pass: Compute predicted y by passing x to the model
-            prediction = model(dataset[j].to(device))
-            error = prediction - dataset[j].y
-            predictions.append(prediction.item())
-            errors.append(error.item())
+        with torch.no_grad():
+            for batch in test_batches:
+                # Forward pass: Compute predicted y by passing x to the model.
+                # Cloned: the output of a CUDA graph replay is overwritten by the next batch
+                predictions.append(model(batch).clone())
+        # Single copy back to the host, batches are in test_ind order
+        predictions = torch.cat(predictions).view(-1).cpu().numpy()
+        errors = predictions - y_test.view(-1).cpu().numpy()
 
         # Compute MAE
-        mae = np.absolute(np.asarray(errors)).mean()
+        mae = np.absolute(errors).mean()
         if NORMALIZE_TARGET:
             mae *= target_std
         print("Mean Absolute Error on test: {:.2f}".format(mae))
@@ -288,19 +389,21 @@ def objective():
             json.dump({
                 "hyperparameters": hyperparameters,
                 "run_parameters": run_parameters,
-                "predicted": predictions,
-                "target": [float(dataset[i].y.item()) for i in test_ind],
+                "predicted": predictions.tolist(),
+                "target": y_test.view(-1).tolist(),
                 "target_std": float(target_std),
                 "target_mean": float(target_mean),
                 "test_frames": test_ind,
                 "train_frames": train_ind,
             }, f)
 
+        # Save the weights of the original module, without the torch.compile wrapper prefix
         torch.save({
-            "parameters": model.state_dict()
+            "parameters": getattr(model, "_orig_mod", model).state_dict()
         }, f"{directory}/parameters.pt")
 
 
-objective()
+if __name__ == "__main__":
+    objective()
 
 